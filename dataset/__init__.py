@@ -41,10 +41,18 @@ def to_loader(
     batch_size: int,
     shuffle: bool=True,
     num_workers: int=os.cpu_count(),
-    pin_memory: bool=torch.cuda.is_available()
+    pin_memory: bool=torch.cuda.is_available(),
+    persistent_workers: bool=False,
+    prefetch_factor: int=None
 ) -> DataLoader:
+    kwargs = {}
+    # DataLoader raises when these are given without workers.
+    if num_workers > 0:
+        kwargs['persistent_workers'] = persistent_workers
+        if prefetch_factor is not None:
+            kwargs['prefetch_factor'] = prefetch_factor
     loader = DataLoader(
         dataset, batch_size, shuffle=shuffle,
-        num_workers=num_workers, pin_memory=pin_memory
+        num_workers=num_workers, pin_memory=pin_memory, **kwargs
     )
     return loader
@@ -1,4 +1,6 @@
 
+import os
+import copy
 import itertools
 
 import torch
@@ -10,7 +12,8 @@ from torchvision.utils import save_image
 
 from dataset import AnimeFaceCelebA, DanbooruPortraitCelebA, to_loader
 from utils import Status, save_args, add_args
-from nnutils import get_device, init
+from nnutils import (
+    get_device, init, compile_model, unwrap_compiled, cudagraph_mark_step_begin, Prefetcher)
 from nnutils.loss import LSGANLoss
 
 from .model import Generator, Discriminator
@@ -21,22 +24,24 @@ def train(
     max_iters, dataset, test,
     GA, GH, DA, DH, optimizer_G, optimizer_D,
     cycle_lambda,
-    amp, device, save
+    amp, bf16, device, save, batch_d=True
 ):
 
-    status = Status(max_iters)
+    status = Status(max_iters, sync_interval=save)
     loss   = LSGANLoss()
-    scaler = GradScaler() if amp else None
+    # bfloat16 has the exponent range of float32. no loss scaling needed.
+    amp_dtype = torch.bfloat16 if bf16 else torch.float16
+    scaler = GradScaler() if amp and not bf16 else None
 
     while status.batches_done < max_iters:
-        for anime, human in dataset:
-            optimizer_D.zero_grad()
-            optimizer_G.zero_grad()
-
-            anime = anime.to(device)
-            human = human.to(device)
-
-            with autocast(amp):
+        prefetcher = Prefetcher(dataset, device, torch.channels_last)
+        batch = prefetcher.next()
+        while batch is not None:
+            anime, human = batch
+            cudagraph_mark_step_begin()
+            optimizer_D.zero_grad(set_to_none=True)
+
+            with autocast(amp, dtype=amp_dtype):
                 '''generate images'''
                 AH = GH(anime)
                 HA = GA(human)
@@ -44,10 +49,18 @@ def train(
                 HAH = GH(HA)
 
                 '''discriminator'''
-                real_anime, _ = DA(anime)
-                real_human, _ = DH(human)
-                fake_anime, _ = DA(HA.detach())
-                fake_human, _ = DH(AH.detach())
+                if batch_d:
+                    # real and fake in one batch per domain.
+                    # only when D does not use batch statistics.
+                    out_anime, _ = DA(torch.cat([anime, HA.detach()], dim=0))
+                    out_human, _ = DH(torch.cat([human, AH.detach()], dim=0))
+                    real_anime, fake_anime = out_anime.chunk(2, dim=0)
+                    real_human, fake_human = out_human.chunk(2, dim=0)
+                else:
+                    real_anime, _ = DA(anime)
+                    real_human, _ = DH(human)
+                    fake_anime, _ = DA(HA.detach())
+                    fake_human, _ = DH(AH.detach())
 
                 # loss
                 adv_anime = loss.d_loss(real_anime, fake_anime)
@@ -61,7 +74,8 @@ def train(
                 D_loss.backward()
                 optimizer_D.step()
 
-            with autocast(amp):
+            optimizer_G.zero_grad(set_to_none=True)
+            with autocast(amp, dtype=amp_dtype):
                 '''generator'''
                 fake_anime, _ = DA(HA)
                 fake_human, _ = DH(AH)
@@ -83,44 +97,42 @@ def train(
 
             # save
             if status.batches_done % save == 0:
+                # uncompiled modules. compiled calls would overwrite outputs of this step.
+                ga, gh = unwrap_compiled(GA), unwrap_compiled(GH)
                 with torch.no_grad():
-                    GA.eval()
-                    GH.eval()
-                    ah = GH(test[0])
-                    ha = GH(test[1])
-                    GA.train()
-                    GH.train()
+                    ga.eval()
+                    gh.eval()
+                    ah = gh(test[0])
+                    ha = gh(test[1])
+                    ga.train()
+                    gh.train()
                 image_grid = _image_grid(test[0], test[1], ah, ha)
                 save_image(image_grid, f'implementations/GANILLA/result/{status.batches_done}.jpg',
                     nrow=4*3, normalize=True, value_range=(-1, 1))
-                ckpt = dict(ga=GA.state_dict(), gh=GH.state_dict())
+                ckpt = dict(ga=unwrap_compiled(GA).state_dict(), gh=unwrap_compiled(GH).state_dict())
                 torch.save(ckpt, f'implementations/GANILLA/result/G_{status.batches_done}.pt')
-            save_image(AH, 'running_AH.jpg', normalize=True, value_range=(-1, 1))
-            save_image(HA, 'running_HA.jpg', normalize=True, value_range=(-1, 1))
+                save_image(AH, 'running_AH.jpg', normalize=True, value_range=(-1, 1))
+                save_image(HA, 'running_HA.jpg', normalize=True, value_range=(-1, 1))
 
             # updates
-            loss_dict = dict(
-                G=G_loss.item() if not torch.isnan(G_loss).any() else 0,
-                D=D_loss.item() if not torch.isnan(D_loss).any() else 0
-            )
-            status.update(**loss_dict)
+            status.update(G=G_loss, D=D_loss)
             if scaler is not None:
                 scaler.update()
 
             if status.batches_done == max_iters:
                 break
+            batch = prefetcher.next()
     status.plot_loss()
 
 def _image_grid(a, h, ah, ha):
-    _split = lambda x: x.chunk(x.size(0), dim=0)
-    a_s = _split(a)
-    hs  = _split(h)
-    ahs = _split(ah)
-    has = _split(ha)
-    images = []
-    for a, h, ah, ha in zip(a_s, hs, ahs, has):
-        images.extend([a, h, ha, ah])
-    return torch.cat(images, dim=0)
+    # interleave to [a0, h0, ha0, ah0, a1, h1, ...]
+    out = a.new_empty((a.size(0)*4, *a.size()[1:]))
+    index = torch.arange(0, out.size(0), 4, device=a.device)
+    out[index]   = a
+    out[index+1] = h
+    out[index+2] = ha
+    out[index+3] = ah
+    return out
 
 def main(parser):
     parser = add_args(parser,
@@ -145,10 +157,17 @@ def main(parser):
             d_act_name       = ['relu', 'activation function name'],
             lr               = [0.0002, 'learning rate'],
             betas            = [[0.5, 0.999], 'betas'],
-            cycle_lambda     = [10., 'lambda for cycle consistency loss']))
+            cycle_lambda     = [10., 'lambda for cycle consistency loss'],
+            compile          = [False, 'compile models with torch.compile'],
+            bf16             = [False, 'use bfloat16 for AMP. disables GradScaler']))
     args = parser.parse_args()
     save_args(args)
 
+    # input shapes are fixed. let cuDNN pick the fastest algorithms.
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+
     amp = not args.disable_amp and not args.disable_gpu
     device = get_device(not args.disable_gpu)
 
@@ -159,11 +178,15 @@ def main(parser):
         dataset = DanbooruPortraitCelebA(args.image_size, num_images=args.num_images+args.num_test)
     dataset, test = random_split(dataset, [len(dataset)-args.num_test, args.num_test])
     # train
-    dataset = to_loader(dataset, args.batch_size)
+    dataset = to_loader(
+        dataset, args.batch_size, num_workers=min(8, os.cpu_count() or 1),
+        pin_memory=not args.disable_gpu, persistent_workers=True, prefetch_factor=2)
     # test
     test = to_loader(test, args.num_test, shuffle=False, pin_memory=False)
     test_batch = next(iter(test))
-    test_batch = (test_batch[0].to(device), test_batch[1].to(device))
+    test_batch = (
+        test_batch[0].to(device, memory_format=torch.channels_last),
+        test_batch[1].to(device, memory_format=torch.channels_last))
 
     if args.max_iters < 0:
         args.max_iters = len(dataset) * args.default_epochs
@@ -175,22 +198,14 @@ def main(parser):
         args.layer_num_blocks, not args.g_disable_sn, args.g_bias,
         args.g_norm_name, args.g_act_name
     )
-    GH = Generator(
-        args.image_size, args.image_channels, args.bottom_width,
-        args.num_downs, args.num_feats, args.g_channels, args.hid_channels,
-        args.layer_num_blocks, not args.g_disable_sn, args.g_bias,
-        args.g_norm_name, args.g_act_name
-    )
+    GH = copy.deepcopy(GA)
     DA = Discriminator(
         args.image_size, args.image_channels, args.num_layers,
         args.d_channels, not args.d_disable_sn, not args.d_disable_bias,
         args.d_norm_name, args.d_act_name
     )
-    DH = Discriminator(
-        args.image_size, args.image_channels, args.num_layers,
-        args.d_channels, not args.d_disable_sn, not args.d_disable_bias,
-        args.d_norm_name, args.d_act_name
-    )
+    DH = copy.deepcopy(DA)
+    # copies are initialized separately to have their own weights
     GA.apply(init().N002)
     GH.apply(init().N002)
     DA.apply(init().N002)
@@ -199,6 +214,14 @@ def main(parser):
     GH.to(device)
     DA.to(device)
     DH.to(device)
+    GA.to(memory_format=torch.channels_last)
+    GH.to(memory_format=torch.channels_last)
+    DA.to(memory_format=torch.channels_last)
+    DH.to(memory_format=torch.channels_last)
+    GA = compile_model(GA, args.compile, mode='reduce-overhead')
+    GH = compile_model(GH, args.compile, mode='reduce-overhead')
+    DA = compile_model(DA, args.compile, mode='reduce-overhead')
+    DH = compile_model(DH, args.compile, mode='reduce-overhead')
 
     # optimizers
     optimizer_G = optim.Adam(
@@ -215,5 +238,6 @@ def main(parser):
         GA, GH, DA, DH,
         optimizer_G, optimizer_D,
         args.cycle_lambda,
-        amp, device, args.save
+        amp, args.bf16, device, args.save,
+        batch_d=args.d_norm_name != 'bn'
     )
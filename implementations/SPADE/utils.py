@@ -1,4 +1,5 @@
 
+import os
 import itertools
 import functools
 
@@ -11,7 +12,8 @@ from torchvision.utils import save_image
 
 from dataset import AnimeFaceXDoG, DanbooruPortraitXDoG, to_loader
 from utils import Status, save_args, add_args
-from nnutils import get_device, sample_nnoise
+from nnutils import (
+    get_device, sample_nnoise, compile_model, unwrap_compiled, cudagraph_mark_step_begin, Prefetcher)
 from nnutils.loss import HingeLoss
 
 from .model import Generator, Discriminator, Encoder, init_weight_xavier
@@ -19,7 +21,8 @@ from .model import Generator, Discriminator, Encoder, init_weight_xavier
 l1 = nn.L1Loss()
 
 def KL_divergence(mu, logvar):
-    return - 0.5 * torch.sum(1 + logvar - mu.pow(2) - logvar.exp())
+    # - 0.5 * sum(1 + logvar - mu^2 - exp(logvar)), in-place on a single temporary
+    return 0.5 * mu.pow(2).add_(logvar.exp()).sub_(logvar).sub_(1).sum()
 
 def feature_matching(real_feats, fake_feats):
     feat_loss = 0
@@ -32,24 +35,27 @@ def train(
     dataset, max_iters, sampler, z_dim, test,
     G, D, E, optimizer_G, optimizer_D,
     kld_lambda, feat_lambda, d_num_scale,
-    device, amp, save=1000
+    device, amp, bf16=False, save=1000
 ):
 
-    status = Status(max_iters)
-    scaler = GradScaler() if amp else None
+    status = Status(max_iters, sync_interval=save)
+    # bfloat16 has the exponent range of float32. no loss scaling needed.
+    amp_dtype = torch.bfloat16 if bf16 else torch.float16
+    scaler = GradScaler() if amp and not bf16 else None
     loss = HingeLoss()
     D_input = lambda x, y: torch.cat([x, y], dim=1)
 
     while status.batches_done < max_iters:
-        for index, (rgb, line) in enumerate(dataset):
-            optimizer_G.zero_grad()
-            optimizer_D.zero_grad()
-
-            rgb = rgb.to(device)
-            line = line.to(device)
+        prefetcher = Prefetcher(dataset, device, torch.channels_last)
+        batch = prefetcher.next()
+        while batch is not None:
+            rgb, line = batch
+            cudagraph_mark_step_begin()
+            optimizer_G.zero_grad(set_to_none=True)
+            optimizer_D.zero_grad(set_to_none=True)
 
             '''Discriminator'''
-            with autocast(amp):
+            with autocast(amp, dtype=amp_dtype):
                 if E is not None:
                     # E(rgb)
                     z, mu, logvar = E(rgb)
@@ -60,7 +66,9 @@ def train(
                 real_outs = D(D_input(line, rgb))
                 # D(line, G(z, line))
                 fake = G(z, line)
-                fake_outs = D(D_input(line, fake.detach()))
+                # shared with the G step
+                fake_pair = D_input(line, fake)
+                fake_outs = D(fake_pair.detach())
                 # loss
                 D_loss = 0
                 for real_out, fake_out in zip(real_outs, fake_outs):
@@ -74,19 +82,23 @@ def train(
                 optimizer_D.step()
 
             '''Generator (+ Encoder)'''
-            with autocast(amp):
-                # D(line, rgb)
-                real_outs = D(D_input(line, rgb))
+            with autocast(amp, dtype=amp_dtype):
+                # D(line, rgb) is not recomputed. real features from the D step,
+                # i.e. before the D update, are used as feature matching targets.
+                # this is an approximation but saves a D forward per step.
+                real_feats = [
+                    [feat.detach() for feat in real_out[1]]
+                    for real_out in real_outs]
                 # D(line, G(z, line))
-                fake_outs = D(D_input(line, fake))
+                fake_outs = D(fake_pair)
                 # loss
                 G_loss = 0
-                for real_out, fake_out in zip(real_outs, fake_outs):
+                for real_feat, fake_out in zip(real_feats, fake_outs):
                     # gan loss
                     G_loss = G_loss + loss.g_loss(fake_out[0]) / d_num_scale
                     # feature matching loss
                     if feat_lambda > 0:
-                        G_loss = G_loss + feature_matching(real_out[1], fake_out[1]) / d_num_scale * feat_lambda
+                        G_loss = G_loss + feature_matching(real_feat, fake_out[1]) / d_num_scale * feat_lambda
                 # KLD loss if E exists
                 if E is not None and kld_lambda > 0:
                     G_loss = G_loss + KL_divergence(mu, logvar) * kld_lambda
@@ -104,47 +116,41 @@ def train(
                 image_grid = _image_grid(line, fake, rgb)
                 save_image(image_grid, f'implementations/SPADE/result/recons_{status.batches_done}.jpg', nrow=3*3, normalize=True, value_range=(-1, 1))
                 # test
-                if E is not None: E.eval()
-                G.eval()
+                # uncompiled modules. compiled calls would overwrite outputs of this step.
+                g = unwrap_compiled(G)
+                e = unwrap_compiled(E) if E is not None else None
+                if e is not None: e.eval()
+                g.eval()
                 with torch.no_grad():
-                    if E is not None: z, _, _ = E(test[0])
+                    if e is not None: z, _, _ = e(test[0])
                     else: z = sampler((test[0].size(0), z_dim))
-                    fake = G(z, test[1])
-                if E is not None: E.train()
-                G.train()
+                    fake = g(z, test[1])
+                if e is not None: e.train()
+                g.train()
                 # save test samples
                 image_grid = _image_grid(test[1], fake, test[0])
                 save_image(image_grid, f'implementations/SPADE/result/test_{status.batches_done}.jpg', nrow=3*3, normalize=True, value_range=(-1, 1))
                 # save models
-                torch.save(G.state_dict(), f'implementations/SPADE/result/G_{status.batches_done}.pt')
+                torch.save(unwrap_compiled(G).state_dict(), f'implementations/SPADE/result/G_{status.batches_done}.pt')
                 if E is not None:
-                    torch.save(E.state_dict(), f'implementations/SPADE/result/E_{status.batches_done}.pt')
+                    torch.save(unwrap_compiled(E).state_dict(), f'implementations/SPADE/result/E_{status.batches_done}.pt')
 
             # updates
-            loss_dict = dict(
-                G=G_loss.item() if not torch.isnan(G_loss).any() else 0,
-                D=D_loss.item() if not torch.isnan(D_loss).any() else 0
-            )
-            status.update(**loss_dict)
+            status.update(G=G_loss, D=D_loss)
             if scaler is not None:
                 scaler.update()
 
             if status.batches_done == max_iters:
                 break
+            batch = prefetcher.next()
     status.plot_loss()
 
 def _image_grid(line, gen, rgb, num_images=6):
-    lines = line.repeat(1, 3, 1, 1).chunk(line.size(0), dim=0) # convert to RGB.
-    gens = gen.chunk(gen.size(0), dim=0)
-    rgbs = rgb.chunk(rgb.size(0), dim=0)
-
-    images = []
-    for index, (line, gen, rgb) in enumerate(zip(lines, gens, rgbs)):
-        images.extend([line, gen, rgb])
-        if index == num_images-1:
-            break
-
-    return torch.cat(images, dim=0)
+    # convert to RGB. expand is a stride-0 view; torch.stack does the only copy.
+    line = line[:num_images].expand(-1, 3, -1, -1)
+    # interleave to [line0, gen0, rgb0, line1, ...]
+    images = torch.stack([line, gen[:num_images], rgb[:num_images]], dim=1)
+    return images.flatten(0, 1)
 
 def main(parser):
 
@@ -179,10 +185,17 @@ def main(parser):
             beta2                 = [0.999, 'beta2'],
             ttur                  = [False, 'use TTUR'],
             kld_lambda            = [0.05, 'lambda for KL divergence'],
-            feat_lambda           = [10., 'lambda for feature matching loss']))
+            feat_lambda           = [10., 'lambda for feature matching loss'],
+            compile               = [False, 'compile models with torch.compile'],
+            bf16                  = [False, 'use bfloat16 for AMP. disables GradScaler']))
     args = parser.parse_args()
     save_args(args)
 
+    # input shapes are fixed. let cuDNN pick the fastest algorithms.
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+
     # # generator
     g_use_sn    = not args.g_disable_sn
     g_use_bias  = not args.g_disable_bias
@@ -202,11 +215,15 @@ def main(parser):
     dataset = DanbooruPortraitXDoG(args.image_size, num_images=args.num_images+args.test_images)
     dataset, test = random_split(dataset, [len(dataset)-args.test_images, args.test_images])
     ## training dataset
-    dataset = to_loader(dataset, args.batch_size)
+    dataset = to_loader(
+        dataset, args.batch_size, num_workers=min(8, os.cpu_count() or 1),
+        pin_memory=not args.disable_gpu, persistent_workers=True, prefetch_factor=2)
     ## test batch
     test    = to_loader(test, args.test_images, shuffle=False, pin_memory=False)
     test_batch = next(iter(test))
-    test_batch = (test_batch[0].to(device), test_batch[1].to(device))
+    test_batch = (
+        test_batch[0].to(device, memory_format=torch.channels_last),
+        test_batch[1].to(device, memory_format=torch.channels_last))
     if args.max_iters < 0:
         args.max_iters = len(dataset) * 100
     ## noise sampler (ignored when E exists)
@@ -228,6 +245,10 @@ def main(parser):
     D.apply(init_weight_xavier)
     G.to(device)
     D.to(device)
+    G.to(memory_format=torch.channels_last)
+    D.to(memory_format=torch.channels_last)
+    G = compile_model(G, args.compile, mode='reduce-overhead')
+    D = compile_model(D, args.compile, mode='reduce-overhead')
     ## create encoder (optional)
     if image_guided:
         E = Encoder(
@@ -237,6 +258,8 @@ def main(parser):
         )
         E.apply(init_weight_xavier)
         E.to(device)
+        E.to(memory_format=torch.channels_last)
+        E = compile_model(E, args.compile, mode='reduce-overhead')
     else:
         E = None
         args.kld_lambda = 0
@@ -261,5 +284,5 @@ def main(parser):
         dataset, args.max_iters, sampler, args.z_dim, test_batch,
         G, D, E, optimizer_G, optimizer_D,
         args.kld_lambda, args.feat_lambda, args.num_scale,
-        device, amp, 1000
+        device, amp, args.bf16, 1000
     )
@@ -12,6 +12,12 @@ def weights_init_normal(m):
         torch.nn.init.normal_(m.weight.data, 1.0, 0.02)
         torch.nn.init.constant_(m.bias.data, 0.0)
 
+def UpConv2d(in_channels, out_channels):
+    '''nearest upsample + conv. used instead of ConvTranspose2d(in, out, 4, 2, 1)'''
+    return nn.Sequential(
+        nn.Upsample(scale_factor=2, mode='nearest'),
+        nn.Conv2d(in_channels, out_channels, 3, 1, 1, bias=False)
+    )
 
 class Generator(nn.Module):
     def __init__(self, latent_dim, label_dim):
@@ -21,19 +27,19 @@ class Generator(nn.Module):
             nn.ConvTranspose2d(latent_dim + label_dim, 1024, 4, 1, 0, bias=False),
             nn.BatchNorm2d(1024),
             nn.ReLU(inplace=True),
-            nn.ConvTranspose2d(1024, 512, 4, 2, 1, bias=False),
+            UpConv2d(1024, 512),
             nn.BatchNorm2d(512),
             nn.ReLU(inplace=True),
-            nn.ConvTranspose2d(512, 256, 4, 2, 1, bias=False),
+            UpConv2d(512, 256),
             nn.BatchNorm2d(256),
             nn.ReLU(inplace=True),
-            nn.ConvTranspose2d(256, 128, 4, 2, 1, bias=False),
+            UpConv2d(256, 128),
             nn.BatchNorm2d(128),
             nn.ReLU(inplace=True),
-            nn.ConvTranspose2d(128, 64, 4, 2, 1, bias=False),
+            UpConv2d(128, 64),
             nn.BatchNorm2d(64),
             nn.ReLU(inplace=True),
-            nn.ConvTranspose2d(64, 3, 4, 2, 1, bias=False),
+            UpConv2d(64, 3),
             nn.Tanh()
         )
     
@@ -74,7 +80,8 @@ class Discriminator(nn.Module):
 
     def _expand_label(self, label):
         label = label.view(-1, self.label_dim, 1, 1)
-        label = label.repeat(1, 1, 128, 128)
+        # view without copy. copied once by torch.cat in forward.
+        label = label.expand(-1, -1, 128, 128)
         return label
 
 if __name__ == "__main__":
@@ -20,7 +20,7 @@ class UpSample(nn.Module):
             nn.Conv2d(in_channel, out_channel*4, 3, 1, 1),
             nn.BatchNorm2d(out_channel*4, 0.8),
             nn.PixelShuffle(2),
-            nn.PReLU()
+            nn.LeakyReLU(0.2, inplace=True)
         )
 
     def forward(self, x):
@@ -1,6 +1,7 @@
 
 from __future__ import annotations
 
+import warnings
 from collections.abc import Callable
 from typing import Any
 
@@ -11,7 +12,8 @@ from nnutils.initialize import init
 from nnutils.training import (
     sample_nnoise,
     sample_unoise,
-    update_ema
+    update_ema,
+    Prefetcher
 )
 from nnutils.accelerate import MiniAccelerator
 
@@ -30,6 +32,36 @@ def unfreeze(model: torch.nn.Module) -> None:
         param.requires_grad = True
     model.train()
 
+def compile_model(
+    model: torch.nn.Module,
+    enabled: bool=True,
+    **kwargs
+) -> torch.nn.Module:
+    '''torch.compile the model.
+    returns the model as is when disabled or torch.compile is not available.
+    '''
+    if enabled:
+        if hasattr(torch, 'compile'):
+            return torch.compile(model, **kwargs)
+        warnings.warn(
+            f'torch.compile is not available in PyTorch {torch.__version__}. Model is not compiled.')
+    return model
+
+def unwrap_compiled(model: torch.nn.Module) -> torch.nn.Module:
+    '''returns the original module of a compiled model.
+    used to save state_dict without the "_orig_mod." prefix.
+    '''
+    return getattr(model, '_orig_mod', model)
+
+def cudagraph_mark_step_begin() -> None:
+    '''mark the beginning of a training step for CUDA graphs of compiled models.
+    outputs of the previous step may be overwritten after this call.
+    no-op when not available.
+    '''
+    compiler = getattr(torch, 'compiler', None)
+    if hasattr(compiler, 'cudagraph_mark_step_begin'):
+        compiler.cudagraph_mark_step_begin()
+
 def profile_once(
     fn: Callable,
     input: tuple[Any],
@@ -1,7 +1,8 @@
 
 from __future__ import annotations
 
-from typing import Union
+from collections.abc import Iterable, Sequence
+from typing import Optional, Union
 import torch
 
 def sample_nnoise(
@@ -38,3 +39,67 @@ def update_ema(
         for key in buffer_ema.keys():
             buffer_ema[key].data.copy_(buffer[key].data)
     model.train()
+
+class Prefetcher:
+    '''Prefetcher
+    copies the next batch to device on a side CUDA stream
+    while the current batch is being processed.
+    falls back to synchronous copies when device is not CUDA.
+    the dataloader should be created with pin_memory=True.
+
+    Usage:
+        prefetcher = Prefetcher(dataloader, device)
+        batch = prefetcher.next()
+        while batch is not None:
+            ...
+            batch = prefetcher.next()
+
+    Arguments:
+        dataloader: DataLoader
+            dataloader which yields a sequence of tensors.
+        device: torch.device
+            device to send the data to.
+        memory_format: torch.memory_format (default: torch.preserve_format)
+            memory format of the tensors on device.
+    '''
+    def __init__(self,
+        dataloader: Iterable,
+        device: Union[torch.device, str],
+        memory_format: torch.memory_format=torch.preserve_format
+    ) -> None:
+        self._iterator = iter(dataloader)
+        self._device = torch.device(device)
+        self._memory_format = memory_format
+        self._stream = torch.cuda.Stream(self._device) \
+            if self._device.type == 'cuda' else None
+        self._preload()
+
+    def _to_device(self, batch: Sequence[torch.Tensor]) -> list[torch.Tensor]:
+        return [
+            tensor.to(self._device, non_blocking=True, memory_format=self._memory_format)
+            for tensor in batch]
+
+    def _preload(self) -> None:
+        try:
+            batch = next(self._iterator)
+        except StopIteration:
+            self._next = None
+            return
+        if self._stream is not None:
+            with torch.cuda.stream(self._stream):
+                self._next = self._to_device(batch)
+        else:
+            self._next = self._to_device(batch)
+
+    def next(self) -> Optional[list[torch.Tensor]]:
+        '''returns the prefetched batch. None if exhausted.'''
+        batch = self._next
+        if batch is None:
+            return None
+        if self._stream is not None:
+            current_stream = torch.cuda.current_stream(self._device)
+            current_stream.wait_stream(self._stream)
+            for tensor in batch:
+                tensor.record_stream(current_stream)
+        self._preload()
+        return batch
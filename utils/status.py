@@ -21,13 +21,16 @@ class Status:
         if given, log status to a file
     log_interval: int (default: 1)
         interval for writing to log file
+    sync_interval: int (default: 1)
+        interval for synchronizing losses given as torch.Tensor
     '''
     def __init__(self,
         max_iters: int,
         bar: bool=True,
         log_file: str=None,
         log_interval: int=1,
-        logger_name: str='logger'
+        logger_name: str='logger',
+        sync_interval: int=1
     ) -> None:
         if bar:
             self.bar = tqdm(total=max_iters)
@@ -43,6 +46,10 @@ class Status:
             self._logger.setLevel(logging.DEBUG)
         self._log_interval = log_interval
         self._step_start = time.time()
+        self._sync_interval = sync_interval
+        self._loss_buffer = None
+        self._num_buffered = 0
+        self._buffered_durations = []
 
     @property
     def max_iters(self):
@@ -99,7 +106,23 @@ class Status:
     '''a step'''
 
     def update(self, **kwargs) -> None:
-        '''update status'''
+        '''update status
+        losses given as torch.Tensor are kept on device and
+        synchronized every "sync_interval" steps, and at the last step.
+        '''
+        duration = time.time() - self._step_start
+        if len(kwargs) > 0 and all(torch.is_tensor(v) for v in kwargs.values()):
+            self._buffer_loss(duration, **kwargs)
+            self._step()
+            if self._num_buffered == self._sync_interval \
+                or self.batches_done == self.max_iters:
+                self._flush_loss()
+        else:
+            self._record_loss(self.batches_done, duration, **kwargs)
+            self._step()
+
+    def _record_loss(self, step, duration, **kwargs) -> None:
+        '''record losses of a step'''
         if self._loss == None:
             self._init_loss(kwargs.keys())
 
@@ -110,13 +133,18 @@ class Status:
 
         # log
         if self._log_file is not None \
-            and self.batches_done % self._log_interval == 0:
+            and step % self._log_interval == 0:
             # FIXME: this ETA is not exact.
-            duration = time.time() - self._step_start
-            eta_sec = int((self.max_iters - self.batches_done) * duration)
+            eta_sec = int((self.max_iters - step) * duration)
             eta = datetime.timedelta(seconds=eta_sec)
             self.log(
-                f'STEP: {self.batches_done} / {self.max_iters} INFO: {kwargs} ETA: {eta}')
+                f'STEP: {step} / {self.max_iters} INFO: {kwargs} ETA: {eta}')
+
+        if hasattr(self, 'bar'):
+            self.bar.set_postfix_str(' '.join(postfix))
+
+    def _step(self) -> None:
+        '''count a step'''
         if self.batches_done == 0:
             # print gpu on first step
             # for checking memory usage
@@ -126,9 +154,32 @@ class Status:
         self._step_start = time.time()
 
         if hasattr(self, 'bar'):
-            self.bar.set_postfix_str(' '.join(postfix))
             self.bar.update(1)
 
+    def _buffer_loss(self, duration, **kwargs) -> None:
+        '''keep losses of a step on device'''
+        values = torch.stack([v.detach().float() for v in kwargs.values()])
+        # NaN is recorded as 0.
+        values = torch.nan_to_num(values, nan=0., posinf=float('inf'), neginf=float('-inf'))
+        if self._loss_buffer is None:
+            self._loss_buffer_keys = tuple(kwargs.keys())
+            self._loss_buffer = values.new_zeros(self._sync_interval, len(kwargs))
+        self._loss_buffer[self._num_buffered] = values
+        self._buffered_durations.append(duration)
+        self._num_buffered += 1
+
+    def _flush_loss(self) -> None:
+        '''synchronize buffered losses and record them'''
+        if self._num_buffered == 0:
+            return
+        values = self._loss_buffer[:self._num_buffered].cpu().tolist()
+        first_step = self.batches_done - self._num_buffered
+        for index, (step_values, duration) in enumerate(zip(values, self._buffered_durations)):
+            self._record_loss(
+                first_step + index, duration, **dict(zip(self._loss_buffer_keys, step_values)))
+        self._num_buffered = 0
+        self._buffered_durations = []
+
     def is_end(self):
         return self.batches_done >= self.max_iters
 
@@ -143,6 +194,7 @@ class Status:
                 self.bar.update(self.batches_done)
 
     def state_dict(self) -> dict:
+        self._flush_loss()
         return dict(
             loss=self._loss,
             batches_done=self.batches_done)
@@ -155,6 +207,7 @@ class Status:
 
     def plot_loss(self, filename='loss'):
         '''plot loss'''
+        self._flush_loss()
         try:
             import matplotlib
             matplotlib.use('agg')